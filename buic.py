@@ -3,8 +3,20 @@
 import argparse
 import os
 import hashlib
-from typing import Dict
+import logging
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple
 import datetime
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 try:
     from termcolor import colored
@@ -14,26 +26,295 @@ except ImportError:
     def colored(text, color):
         return text  # fallback if termcolor is not installed
 
+try:
+    import blake3
+    blake3_installed = True
+except ImportError:
+    blake3_installed = False
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20  # 1 MiB reads keep syscall and update() overhead low
+WRITE_BUFFER_SIZE = 1 << 20  # buffer for writing the hash file
+WRITE_BATCH = 1024  # manifest lines handed to writelines() at once
+PROGRESS_INTERVAL = 0.1  # seconds between progress line redraws
+PROGRESS_WIDTH = 79
+WALK_QUEUE_SIZE = 1024  # entries the background walker may run ahead of the hashers
+
+# BLAKE3 is much faster than SHA256 on CPUs without SHA extensions, but needs the blake3 module
+ALGORITHMS = ('sha256', 'blake3')
+DEFAULT_ALGO = 'sha256'
+
+# Binary hash file: magic and a version byte, then per file a little-endian
+# record header, the path bytes and the raw 32-byte digest.
+# Version 1 headers hold the path length, version 2 adds size and mtime_ns,
+# version 3 stores the algorithm (u8 length + name) after the version byte.
+BINARY_MAGIC = b'BUIC'
+BINARY_VERSION = 3
+BINARY_RECORDS = {1: struct.Struct('<H'), 2: struct.Struct('<HQq'), 3: struct.Struct('<HQq')}
+DIGEST_SIZE = 32
+
+# (size, mtime_ns, digest); size and mtime_ns are None for entries written without them
+Record = Tuple[Optional[int], Optional[int], bytes]
+
+
+class Manifest(NamedTuple):
+    """A loaded hash file as parallel arrays sorted by path, searched with bisect.
+
+    Much smaller than a dict of per-file tuples for hash files with millions of entries.
+    Backup writes entries in walk order, so every load pays one sort (about 2 s per
+    million entries). sizes holds -1 for entries written without size and mtime_ns.
+    """
+    algo: str
+    paths: List[str]
+    sizes: array
+    mtimes: array
+    digests: bytes  # DIGEST_SIZE bytes per path, concatenated
+
+
+def check_algo(algo):
+    if algo not in ALGORITHMS:
+        print(f"Error: unsupported hash algorithm {algo}.")
+        exit(1)
+    if algo == 'blake3' and not blake3_installed:
+        print("Error: the blake3 algorithm requires 'blake3', install it via 'pip install blake3'.")
+        exit(1)
+
+
+def new_digest(algo):
+    return blake3.blake3() if algo == 'blake3' else hashlib.sha256()
+
+
+def fadvise(fd, advice):
+    """posix_fadvise the whole file; a no-op where unsupported (Windows, macOS)."""
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except (AttributeError, OSError):
+        pass
+
+
+def calculate_digest(filepath, algo=DEFAULT_ALGO):
+    with open(filepath, 'rb', buffering=0) as f:
+        # Hint the kernel to read ahead aggressively
+        fadvise(f.fileno(), 'POSIX_FADV_SEQUENTIAL')
+        # Read into one reused buffer to avoid a new bytes per chunk. This is the same
+        # Python-level loop as hashlib.file_digest, but with a larger buffer.
+        digest = new_digest(algo)
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            digest.update(view[:n])
+        # Each file is read once, so drop its pages instead of evicting more useful cache
+        fadvise(f.fileno(), 'POSIX_FADV_DONTNEED')
+    return digest.digest()
+
+
+def try_hash_file(entry, algo=DEFAULT_ALGO):
+    """Return ((size, mtime_ns, hash), None) on success or (None, error) so one bad file doesn't stop a pool."""
+    try:
+        # stat before hashing so a file modified mid-hash gets rehashed on the next verify
+        st = entry.stat()
+        return (st.st_size, st.st_mtime_ns, calculate_digest(entry.path, algo)), None
+    except Exception as e:
+        return None, e
+
+
+def worker_count():
+    """Two hashing threads per usable logical CPU.
+
+    Both reading and hashing release the GIL. While one thread waits for its read()
+    to return, the other can hash on the same CPU, so I/O waits overlap with work.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return 2 * cpus
+
+
+def iter_files(directory, skip=None):
+    """Yield a DirEntry for every file under directory, like os.walk without symlinked dirs.
+
+    skip is an optional (st_dev, st_ino) of a file to leave out, such as the hash file
+    being written or read when it lands inside directory.
+    """
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                subdirs = []
+                for entry in it:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    # inode() comes from the directory listing; only stat on a match
+                    elif not (skip and entry.inode() == skip[1]
+                              and entry.stat(follow_symlinks=False).st_dev == skip[0]):
+                        yield entry
+        except OSError:
+            continue  # unreadable directory, os.walk skips these too
+        stack.extend(reversed(subdirs))
+
+
+def walk_in_background(directory, found, skip=None):
+    """Yield iter_files(directory) entries produced by a walker thread through a bounded queue.
 
-def calculate_sha256(filepath):
-    sha256 = hashlib.sha256()
-    with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            sha256.update(chunk)
-    return sha256.hexdigest()
+    The walker appends the total number of files to found once the walk is done.
+    skip is passed on to iter_files.
+    """
+    entries = queue.Queue(maxsize=WALK_QUEUE_SIZE)
 
+    def walk():
+        count = 0
+        try:
+            for entry in iter_files(directory, skip):
+                entries.put(entry)
+                count += 1
+        finally:
+            found.append(count)
+            entries.put(None)
 
-def load_hashes(hash_file: str) -> Dict[str, str]:
-    hashes = {}
-    with open(hash_file, 'r') as f:
+    threading.Thread(target=walk, daemon=True).start()
+    yield from iter(entries.get, None)
+
+
+def bounded_map(ex, fn, items, window):
+    """Yield (item, fn(item)) in order like ex.map, but with at most window calls in flight.
+
+    ex.map consumes its whole input up front, creating one Future per item, which would
+    defeat a lazy walk and costs about 1.6 KB per file.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, ex.submit(fn, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def text_header(algo):
+    return f"# algo={algo}\n"
+
+
+def binary_header(algo):
+    name = algo.encode('ascii')
+    return BINARY_MAGIC + bytes([BINARY_VERSION, len(name)]) + name
+
+
+def text_entry(rel_path, record):
+    size, mtime_ns, hash_value = record
+    return f"{rel_path}:::{size}:::{mtime_ns}:::{hash_value.hex()}\n"
+
+
+def binary_entry(rel_path, record):
+    size, mtime_ns, hash_value = record
+    path = os.fsencode(rel_path)
+    return BINARY_RECORDS[BINARY_VERSION].pack(len(path), size, mtime_ns) + path + hash_value
+
+
+def make_manifest(algo, paths, sizes, mtimes, digests) -> Manifest:
+    # Hash files are written in walk order, not path order, so always sort once here
+    order = sorted(range(len(paths)), key=paths.__getitem__)
+    paths = [paths[i] for i in order]
+    sizes = array('q', (sizes[i] for i in order))
+    mtimes = array('q', (mtimes[i] for i in order))
+    digests = b''.join(digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] for i in order)
+    return Manifest(algo, paths, sizes, mtimes, bytes(digests))
+
+
+def find_record(manifest: Manifest, rel_path: str) -> Optional[Record]:
+    i = bisect_left(manifest.paths, rel_path)
+    if i == len(manifest.paths) or manifest.paths[i] != rel_path:
+        return None
+    digest = manifest.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+    if manifest.sizes[i] < 0:
+        return None, None, digest
+    return manifest.sizes[i], manifest.mtimes[i], digest
+
+
+def load_binary_hashes(f, version) -> Manifest:
+    header = BINARY_RECORDS[version]
+    paths, sizes, mtimes, digests = [], array('q'), array('q'), bytearray()
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        offset = len(BINARY_MAGIC) + 1
+        algo = DEFAULT_ALGO
+        if version >= 3:
+            name_len = buf[offset]
+            algo = buf[offset + 1:offset + 1 + name_len].decode('ascii')
+            offset += 1 + name_len
+        end = len(buf)
+        while offset + header.size <= end:
+            path_len, *meta = header.unpack_from(buf, offset)
+            size, mtime_ns = meta or (-1, -1)
+            offset += header.size
+            paths.append(os.fsdecode(buf[offset:offset + path_len]))
+            offset += path_len
+            sizes.append(size)
+            mtimes.append(mtime_ns)
+            digests += buf[offset:offset + DIGEST_SIZE]
+            offset += DIGEST_SIZE
+    if offset != end:
+        print(f"Error: hash file {f.name} is truncated.")
+        exit(1)
+    return make_manifest(algo, paths, sizes, mtimes, digests)
+
+
+def load_hashes(hash_file: str) -> Manifest:
+    """Load hash_file, in either format, along with the hash algorithm it names."""
+    with open(hash_file, 'rb') as f:
+        header = f.read(len(BINARY_MAGIC) + 1)
+        # An unknown version byte means a text hash file whose first path starts with the magic
+        if header[:-1] == BINARY_MAGIC and header[-1] in BINARY_RECORDS:
+            return load_binary_hashes(f, header[-1])
+    algo = DEFAULT_ALGO
+    paths, sizes, mtimes, digests = [], array('q'), array('q'), bytearray()
+    with open(hash_file, 'r', errors='surrogateescape') as f:
         for line in f:
-            if ':::' in line:
-                rel_path, hashval = line.strip().split(':::', 1)
-                hashes[rel_path] = hashval
-    return hashes
+            # rel:::size:::mtime_ns:::digest, or rel:::sha256 in older hash files
+            rel_path, sep, hashval = line.strip().partition(':::')
+            if not sep:
+                if rel_path.startswith('# algo='):
+                    algo = rel_path[len('# algo='):]
+                continue
+            size = mtime_ns = -1
+            try:
+                if ':::' in hashval:
+                    size, _, hashval = hashval.partition(':::')
+                    mtime_ns, _, hashval = hashval.partition(':::')
+                    size, mtime_ns = int(size), int(mtime_ns)
+                digest = bytes.fromhex(hashval)
+            except ValueError:
+                continue  # corrupt entry, the file will show up as not in the hash file
+            if len(digest) != DIGEST_SIZE:
+                continue
+            paths.append(rel_path)
+            sizes.append(size)
+            mtimes.append(mtime_ns)
+            digests += digest
+    return make_manifest(algo, paths, sizes, mtimes, digests)
+
+
+def progress_line(idx, total, rel_path):
+    if total is None:
+        # Still walking the directory, so only the count so far is known
+        text = f"({idx}/?) {rel_path}"
+    else:
+        percent = idx * 100 // total
+        bar_len = 30
+        filled_len = bar_len * idx // total
+        bar = '#' * filled_len + '-' * (bar_len - filled_len)
+        text = f"[{bar}] {percent}% ({idx}/{total}) {rel_path}"
+    if len(text) > PROGRESS_WIDTH:
+        # Truncate the path and add ellipsis
+        text = text[:PROGRESS_WIDTH - 3] + "..."
+    # Pad so a shorter line fully overwrites the previous one
+    return '\r' + text.ljust(PROGRESS_WIDTH)
 
 
-def verify_hashes(directory: str, hash_file: str):
+def verify_hashes(directory: str, hash_file: str, paranoid: bool = False):
     if not os.path.isdir(directory):
         print(f"Error: {directory} is not a valid directory.")
         exit(1)
@@ -41,34 +322,78 @@ def verify_hashes(directory: str, hash_file: str):
         print(f"Error: {hash_file} does not exist.")
         exit(1)
 
-    hashes = load_hashes(hash_file)
+    manifest = load_hashes(hash_file)
+    algo = manifest.algo
+    check_algo(algo)
+    log.debug("Loaded %d %s hashes from %s", len(manifest.paths), algo, hash_file)
     verified_count = 0
+    unchanged_count = 0
     failed_count = 0
     results = []
 
-    # Find the longest file name for alignment
-    max_file_len = max((len(file) for root, _, files in os.walk(directory) for file in files), default=0)
-    status_col = max_file_len + 8  # 8 is a buffer for spacing and dashes
+    prefix_len = len(os.path.join(directory, ''))
+    # The hash file may live inside the tree it describes; it is not one of its own entries
+    hash_stat = os.stat(hash_file)
+    all_files = [(entry, entry.path[prefix_len:])
+                 for entry in iter_files(directory, (hash_stat.st_dev, hash_stat.st_ino))]
+    results_raw = []
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            filepath = os.path.join(root, file)
-            rel_path = os.path.relpath(filepath, directory)
-            hash_value = calculate_sha256(filepath)
-            expected_hash = hashes.get(rel_path)
-            if expected_hash == hash_value:
+    def check(item):
+        """Return (outcome, detail) for one file; errors are caught so one bad file doesn't stop the pool."""
+        entry, rel_path = item
+        record = find_record(manifest, rel_path)
+        if record is None:
+            return 'missing', None  # not in the hash file, no point hashing it
+        size, mtime_ns, expected_hash = record
+        try:
+            if not paranoid and size is not None:
+                st = entry.stat()
+                if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                    return 'unchanged', None  # same size and mtime as at backup, not hashed
+            hash_value = calculate_digest(entry.path, algo)
+        except Exception as e:
+            return 'unreadable', e
+        if hash_value == expected_hash:
+            return 'verified', None
+        return 'failed', (hash_value, expected_hash)
+
+    # hashlib releases the GIL while hashing, so threads scale across cores;
+    # bounded_map yields results in submission order to keep the output deterministic, and
+    # unlike ex.map it does not create a Future for every file up front
+    workers = worker_count()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for (_, rel_path), (outcome, detail) in bounded_map(ex, check, all_files, 4 * workers):
+            log.debug("Verifying: %s", rel_path)
+            if outcome == 'missing':
+                status = colored('not in hash file', 'red')
+                failed_count += 1
+            elif outcome == 'verified':
                 status = colored('verified', 'green')
                 verified_count += 1
+            elif outcome == 'unchanged':
+                status = colored('unchanged (not hashed)', 'yellow')
+                unchanged_count += 1
+            elif outcome == 'unreadable':
+                log.debug("Failed to read %s: %s", rel_path, detail)
+                status = colored('failed to read', 'red')
+                failed_count += 1
             else:
-                status = colored('failed verification', 'red')
+                # Raw digests are compared; hex-encode only to report a mismatch
+                hash_value, expected_hash = detail
+                status = colored(f'failed verification ({hash_value.hex()} != {expected_hash.hex()})', 'red')
                 failed_count += 1
-            dash_count = status_col - len(rel_path)
-            dashes = '-' * dash_count
-            result_line = f"{rel_path} {dashes} {status}"
-            print(result_line)
-            results.append(result_line)
+            results_raw.append((rel_path, status))
+
+    # Align the status column on the longest path, known once every file is hashed
+    max_file_len = max((len(rel_path) for rel_path, _ in results_raw), default=0)
+    status_col = max_file_len + 8  # 8 is a buffer for spacing and dashes
+    dash_template = '-' * status_col  # sliced per row instead of building new dashes
+    for rel_path, status in results_raw:
+        result_line = f"{rel_path} {dash_template[:status_col - len(rel_path)]} {status}"
+        print(result_line)
+        results.append(result_line)
 
-    total_files = verified_count + failed_count
+    total_files = verified_count + unchanged_count + failed_count
 
     summary_title = "Summary"
     box_width = len(summary_title) + 2
@@ -81,6 +406,7 @@ def verify_hashes(directory: str, hash_file: str):
     print(top_bottom_border)
     print(f"Total files: {total_files}")
     print(f"Verified: {verified_count}")
+    print(f"Unchanged (not hashed): {unchanged_count}")
     failed_line = f"Failed Verification: {failed_count}"
     if failed_count > 0:
         print(colored(failed_line, 'red'))
@@ -93,7 +419,7 @@ def verify_hashes(directory: str, hash_file: str):
     abs_dir = os.path.abspath(directory)
     dir_part = abs_dir.lstrip(os.sep).replace(os.sep, '_')
     summary_file = f"{dir_part}_hashverified_{now:%m_%d_%Y}.txt"
-    with open(summary_file, 'w') as out:
+    with open(summary_file, 'w', errors='surrogateescape') as out:
         for line in results:
             out.write(line + '\n')
         out.write(f"\n{top_bottom_border}\n")
@@ -101,14 +427,24 @@ def verify_hashes(directory: str, hash_file: str):
         out.write(f"{top_bottom_border}\n")
         out.write(f"Total files: {total_files}\n")
         out.write(f"Verified: {verified_count}\n")
+        out.write(f"Unchanged (not hashed): {unchanged_count}\n")
         out.write(f"Failed Verification: {failed_count}\n")
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Backup Integrity Check: Generate or verify SHA256 hashes for files in a directory.')
+    parser = argparse.ArgumentParser(description='Backup Integrity Check: Generate or verify SHA256 (or BLAKE3) hashes for files in a directory.')
     parser.add_argument('-b', '--backup', help='Directory to enumerate and hash files from')
     parser.add_argument('-v', '--verify', nargs=2, metavar=('DIRECTORY', 'HASHFILE'), help='Verify hashes in DIRECTORY using HASHFILE')
+    parser.add_argument('-f', '--format', choices=('text', 'binary'), default='text',
+                        help='Hash file format written by --backup (default: text); --verify detects it')
+    parser.add_argument('-a', '--algo', choices=ALGORITHMS, default=DEFAULT_ALGO,
+                        help='Hash algorithm used by --backup (default: sha256); --verify reads it from the hash file')
+    parser.add_argument('-p', '--paranoid', action='store_true',
+                        help='With --verify, rehash every file even if its size and modification time are unchanged')
+    parser.add_argument('-d', '--debug', action='store_true', help='Print debug messages')
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING,
+                        format='[%(levelname)s] %(message)s')
 
     if not termcolor_installed:
         print("[Warning] For colored output, install 'termcolor' via 'pip install termcolor'.")
@@ -121,40 +457,51 @@ def main():
         now = datetime.datetime.now()
         abs_dir = os.path.abspath(directory)
         dir_part = abs_dir.lstrip(os.sep).replace(os.sep, '_')
-        output_file = f"{dir_part}_hashes_{now:%m_%d_%Y}.txt"
-        # Collect all files first for progress bar
-        all_files = []
-        for root, _, files in os.walk(directory):
-            for file in files:
-                filepath = os.path.join(root, file)
-                rel_path = os.path.relpath(filepath, directory)
-                all_files.append((filepath, rel_path))
-        total_files = len(all_files)
-        with open(output_file, 'w') as out:
-            for idx, (filepath, rel_path) in enumerate(all_files, 1):
-                # Clear the line before printing the new file name
-                print('\r' + ' ' * 70 + '\r', end='')
-                # Limit the display to 80 characters total
-                display_text = f"Hashing: {rel_path}"
-                if len(display_text) > 70:
-                    # Truncate the path and add ellipsis
-                    max_path_len = 70 - len("Hashing: ...")
-                    truncated_path = rel_path[:max_path_len] + "..."
-                    display_text = f"Hashing: {truncated_path}"
-                print(display_text, end='\r')
-                try:
-                    hash_value = calculate_sha256(filepath)
-                    out.write(f"{rel_path}:::{hash_value}\n")
-                except Exception as e:
-                    print(f"Failed to hash {filepath}: {e}")
-                # Progress bar
-                percent = int((idx / total_files) * 100)
-                bar_len = 60
-                filled_len = int(bar_len * idx // total_files)
-                bar = '#' * filled_len + '-' * (bar_len - filled_len)
-                print(f"\n[{bar}] {percent}% ({idx}/{total_files})", end='\033[F' if idx < total_files else '\n')
+        binary = args.format == 'binary'
+        output_file = f"{dir_part}_hashes_{now:%m_%d_%Y}.{'bin' if binary else 'txt'}"
+        make_entry = binary_entry if binary else text_entry
+        check_algo(args.algo)
+        # Hash while the directory is still being walked; the total is known once the walk ends
+        prefix_len = len(os.path.join(directory, ''))
+        found = []
+        workers = worker_count()
+        idx = 0
+        last_update = 0.0
+        batch = [binary_header(args.algo) if binary else text_header(args.algo)]
+        # Entries are written as they are hashed, in walk order, so memory use stays flat and an
+        # interrupted backup leaves a partial hash file; load_hashes sorts them for bisect lookups
+        # surrogateescape writes names that are not valid UTF-8 back as their original bytes
+        with open(output_file, 'wb' if binary else 'w', buffering=WRITE_BUFFER_SIZE,
+                  errors=None if binary else 'surrogateescape') as out, \
+                ThreadPoolExecutor(max_workers=workers) as ex:
+            # The hash file is already open, so keep it out of its own hashes
+            out_stat = os.fstat(out.fileno())
+            results = bounded_map(ex, partial(try_hash_file, algo=args.algo),
+                                  walk_in_background(directory, found, (out_stat.st_dev, out_stat.st_ino)),
+                                  4 * workers)
+            for idx, (entry, (record, error)) in enumerate(results, 1):
+                rel_path = entry.path[prefix_len:]
+                if error is None:
+                    log.debug("Writing: %s", rel_path)
+                    batch.append(make_entry(rel_path, record))
+                    if len(batch) >= WRITE_BATCH:
+                        out.writelines(batch)
+                        batch.clear()
+                else:
+                    sys.stdout.write('\r' + ' ' * PROGRESS_WIDTH + '\r')
+                    print(f"Failed to hash {entry.path}: {error}")
+                    last_update = 0.0  # redraw the progress line right away
+                # Redrawing for every file would make stdout the bottleneck on many small files
+                tick = time.monotonic()
+                if tick - last_update >= PROGRESS_INTERVAL:
+                    last_update = tick
+                    sys.stdout.write(progress_line(idx, found[0] if found else None, rel_path))
+                    sys.stdout.flush()
+            out.writelines(batch)
+        if idx:
+            sys.stdout.write(progress_line(idx, idx, rel_path) + '\n')
     elif args.verify:
-        verify_hashes(args.verify[0], args.verify[1])
+        verify_hashes(args.verify[0], args.verify[1], args.paranoid)
     else:
         parser.print_help()
 